@@ -0,0 +1,62 @@
+import io
+import os
+import time
+import types
+
+import pytest
+
+from ubireader import settings
+from ubireader.ubifs import output, walk
+from ubireader.ubifs.defines import *
+
+
+def _ino(inum, mode, size=0, data=b''):
+    return types.SimpleNamespace(key={'ino_num': inum}, mode=mode, size=size, nlink=1,
+                                 uid=os.getuid(), gid=os.getgid(), atime_sec=0,
+                                 mtime_sec=0, data=data)
+
+
+def _dent(inum, name, itype):
+    return types.SimpleNamespace(inum=inum, name=name, type=itype)
+
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_duplicate_name_symlink_not_followed(tmp_path, monkeypatch, jobs):
+    """A REG and a LNK dent of the same name must not write through the link."""
+    content = b'payload'
+    raw = io.BytesIO(content)
+    data = types.SimpleNamespace(key={'khash': UBIFS_DATA_KEY << UBIFS_S_KEY_BLOCK_BITS},
+                                 offset=0, compr_len=len(content), compr_type=UBIFS_COMPR_NONE,
+                                 size=len(content), plaintext_size=len(content))
+
+    victim = tmp_path / 'victim'
+    victim.write_bytes(b'original')
+    out = tmp_path / 'out'
+    out.mkdir()
+
+    inodes = {
+        1: {'ino': _ino(1, 0o40755),
+            'dent': [_dent(2, 'foo', UBIFS_ITYPE_REG), _dent(3, 'foo', UBIFS_ITYPE_LNK)]},
+        2: {'ino': _ino(2, 0o100644, len(content)), 'data': [data]},
+        3: {'ino': _ino(3, 0o120777, data=str(victim).encode())},
+    }
+    ubifs = types.SimpleNamespace(file=raw, master_key=None,
+                                  master_node=types.SimpleNamespace(root_lnum=0, root_offs=0))
+    monkeypatch.setattr(walk, 'index', lambda ubifs, lnum, offs, ino, bad_blocks: ino.update(inodes))
+    monkeypatch.setattr(settings, 'extract_jobs', jobs)
+
+    if jobs > 1:
+        # Hold the worker back until the walker has created the symlink.
+        reg_file_iter = output.process_reg_file_iter
+
+        def delayed(ubifs, inode, path, inodes):
+            deadline = time.monotonic() + 5
+            while not os.path.islink(path) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            return reg_file_iter(ubifs, inode, path, inodes)
+
+        monkeypatch.setattr(output, 'process_reg_file_iter', delayed)
+
+    output.extract_files(ubifs, str(out))
+
+    assert victim.read_bytes() == b'original'
@@ -21,13 +21,16 @@ import sys
 import traceback
 from ubireader import settings
 
-def log(obj, message):
+def log(obj, message, *args):
+    # Format args here, so callers pay nothing while logging is off.
     if settings.logging_on or settings.logging_on_verbose:
+        if args:
+            message = message % args
         print('{} {}'.format(obj.__name__, message))
 
-def verbose_log(obj, message):
+def verbose_log(obj, message, *args):
     if settings.logging_on_verbose:
-        log(obj, message)
+        log(obj, message, *args)
 
 def verbose_display(displayable_obj):
     if settings.logging_on_verbose:
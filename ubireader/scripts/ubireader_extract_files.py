@@ -86,6 +86,12 @@ def main():
     parser.add_argument('-o', '--output-dir', dest='outpath',
                         help='Specify output directory path.')
 
+    parser.add_argument('-j', '--jobs', type=int, dest='jobs',
+                        help='Number of threads extracting files. (default: number of CPUs)')
+
+    parser.add_argument('--direct-io-threshold', type=int, dest='direct_io_threshold',
+                        help='Write files of this many bytes or more with O_DIRECT, bypassing the page cache. (default: 0, disabled)')
+
     parser.add_argument('-K', '--master-key', dest='master_key',
                       help='Master key file, given with fscryptctl e.g. to encrypt the UBIFS (support limited to fscrypt v1 policies)')
 
@@ -107,6 +113,16 @@ def main():
 
     settings.uboot_fix = args.uboot_fix
 
+    if args.jobs is not None and args.jobs < 1:
+        parser.error('Jobs must be 1 or more.')
+
+    settings.extract_jobs = args.jobs
+
+    if args.direct_io_threshold is not None:
+        if args.direct_io_threshold < 0:
+            parser.error('Direct IO threshold must be 0 or more.')
+        settings.direct_io_threshold = args.direct_io_threshold
+
     if args.master_key:
         path = args.master_key
         if not os.path.exists(path):
@@ -162,6 +178,9 @@ def main():
     # Create file object.
     ufile_obj = ubi_file(path, block_size, start_offset, end_offset)
 
+    # Start reading the image in while the index is being walked.
+    ufile_obj.readahead()
+
     if filetype == UBI_EC_HDR_MAGIC:
         # Create UBI object
         ubi_obj = ubi(ufile_obj)
@@ -31,7 +31,7 @@ from ubireader.ubifs.list import list_files, copy_file
 from ubireader.ubifs.defines import UBIFS_NODE_MAGIC
 from ubireader.ubi_io import ubi_file, leb_virtual_file
 from ubireader.debug import error, log
-from ubireader.utils import guess_filetype, guess_start_offset, guess_leb_size, guess_peb_size
+from ubireader.utils import guess_filetype, guess_start_offset, guess_leb_size, guess_peb_size, load_guess_cache, save_guess_cache
 
 def main():
     start = time.time()
@@ -78,6 +78,9 @@ def main():
     parser.add_argument('-D', '--copy-dest', dest='copyfiledest',
                         help='Copy Destination.')
 
+    parser.add_argument('--guess-cache', action='store_true', dest='guess_cache',
+                      help='Cache guessed offset and block size in the user cache dir, reused on later runs of the same image. (default: False)')
+
     parser.add_argument('-K', '--master-key', dest='master_key',
                       help='Master key file, given with fscryptctl e.g. to encrypt the UBIFS (support limited to fscrypt v1 policies)')
 
@@ -99,6 +102,8 @@ def main():
 
     settings.uboot_fix = args.uboot_fix
 
+    settings.use_guess_cache = args.guess_cache
+
     if args.master_key:
         path = args.master_key
         if not os.path.exists(path):
@@ -117,36 +122,49 @@ def main():
         if not os.path.exists(path):
             parser.error("File path doesn't exist.")
 
-    if args.start_offset:
-        start_offset = args.start_offset
-    elif args.guess_offset:
-        start_offset = guess_start_offset(path, args.guess_offset)
-    else:
-        start_offset = guess_start_offset(path)
-
     if args.end_offset:
         end_offset = args.end_offset
     else:
         end_offset = None
 
-    filetype = guess_filetype(path, start_offset)
-    if not filetype:
-        parser.error('Could not determine file type.')
+    # Guessing scans the whole image, reuse earlier results for it.
+    use_cache = settings.use_guess_cache and not args.start_offset and not args.block_size
+    guessed = load_guess_cache(path, args.guess_offset) if use_cache else None
 
-    if args.block_size:
-        block_size = args.block_size
+    if guessed:
+        start_offset, block_size, filetype = guessed
     else:
-        if filetype == UBI_EC_HDR_MAGIC:
-            block_size = guess_peb_size(path)
-        elif filetype == UBIFS_NODE_MAGIC:
-            block_size = guess_leb_size(path)
-
-        if not block_size:
-            parser.error('Block size could not be determined.')
+        if args.start_offset:
+            start_offset = args.start_offset
+        elif args.guess_offset:
+            start_offset = guess_start_offset(path, args.guess_offset)
+        else:
+            start_offset = guess_start_offset(path)
+
+        filetype = guess_filetype(path, start_offset)
+        if not filetype:
+            parser.error('Could not determine file type.')
+
+        if args.block_size:
+            block_size = args.block_size
+        else:
+            if filetype == UBI_EC_HDR_MAGIC:
+                block_size = guess_peb_size(path)
+            elif filetype == UBIFS_NODE_MAGIC:
+                block_size = guess_leb_size(path)
+
+            if not block_size:
+                parser.error('Block size could not be determined.')
+
+        if use_cache:
+            save_guess_cache(path, args.guess_offset, start_offset, block_size, filetype)
 
     # Create file object.
     ufile_obj = ubi_file(path, block_size, start_offset, end_offset)
 
+    # Start reading the image in while the index is being walked.
+    ufile_obj.readahead()
+
     if filetype == UBI_EC_HDR_MAGIC:
         # Create UBI object
         ubi_obj = ubi(ufile_obj)
@@ -31,4 +31,9 @@ logging_on_verbose = False              # Print verbose debug info on.
 use_dummy_socket_file = False           # Create regular file place holder for sockets.
 use_dummy_devices = False               # Create regular file place holder for devices.
 
+extract_jobs = None                     # Threads extracting regular files, None for one per CPU.
+direct_io_threshold = 0                 # Write extracted files this size or larger with O_DIRECT, 0 disables.
+
+use_guess_cache = False                 # Cache guessed image offsets and block sizes in the user cache dir.
+
 uboot_fix = False                       # Older u-boot sets image_seq to 0 on blocks it's written to.
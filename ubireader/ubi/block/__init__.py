@@ -132,7 +132,7 @@ def extract_blocks(ubi):
             blocks[blk.peb_num] = blk
             peb_count += 1
             log(extract_blocks, blk)
-            verbose_log(extract_blocks, 'file addr: %s' % (ubi.file.last_read_addr()))
+            verbose_log(extract_blocks, 'file addr: %s', ubi.file.last_read_addr())
             ec_hdr_errors = ''
             vid_hdr_errors = ''
 
@@ -17,10 +17,48 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #############################################################
 
+import os
+import mmap
 from ubireader.debug import error, log, verbose_log
 from ubireader.ubi.block import sort
 from ubireader.ubi.defines import UBI_VID_STATIC
 
+class mapped_file(object):
+    """Read only file object backed by a memory map
+
+    Arguments:
+    Obj:fhandle      -- Open file to map.
+
+    Serves seek/read/tell from the page cache without a syscall per
+    read. Like a regular file, seeking past the end is allowed and
+    reads there return empty.
+    """
+
+    def __init__(self, fhandle):
+        self._map = mmap.mmap(fhandle.fileno(), 0, access=mmap.ACCESS_READ)
+        self._pos = 0
+
+    def close(self):
+        self._map.close()
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += len(self._map)
+        self._pos = offset
+
+    def read(self, size=-1):
+        end = len(self._map) if size < 0 else self._pos + size
+        buf = self._map[self._pos:end]
+        self._pos += len(buf)
+        return buf
+
+    def tell(self):
+        return self._pos
+
+
+
 class ubi_file(object):
     """UBI image file object
 
@@ -37,6 +75,8 @@ class ubi_file(object):
     read            -- Read specified bytes from file handle.
         Int:size
     tell            -- Returns byte offset of current file location.
+    fileno          -- Returns file descriptor of the image file.
+    readahead       -- Hint the kernel to read start to end offset ahead.
     read_block      -- Returns complete PEB data of provided block
                        description.
         Obj:block
@@ -55,10 +95,18 @@ class ubi_file(object):
         self.is_valid = False
         try:
             log(self, 'Open Path: %s' % path)
-            self._fhandle = open(path, 'rb')
+            self._file = open(path, 'rb')
         except Exception as e:
             error(self, 'Fatal', 'Open file: %s' % e)
 
+        try:
+            self._fhandle = mapped_file(self._file)
+            log(self, 'Mapped file into memory.')
+        except (ValueError, OSError, OverflowError) as e:
+            # Empty files, devices and 32bit address spaces.
+            log(self, 'Could not map file, using reads: %s' % e)
+            self._fhandle = self._file
+
         self._fhandle.seek(0,2)
         file_size = self.tell()
         log(self, 'File Size: %s' % file_size)
@@ -113,6 +161,7 @@ class ubi_file(object):
 
     def close(self):
         self._fhandle.close()
+        self._file.close()
 
     def seek(self, offset):
         self._fhandle.seek(offset)
@@ -120,7 +169,7 @@ class ubi_file(object):
 
     def read(self, size):
         self._last_read_addr = self.tell()
-        verbose_log(self, 'read loc: %s, size: %s' % (self._last_read_addr, size))
+        verbose_log(self, 'read loc: %s, size: %s', self._last_read_addr, size)
         return self._fhandle.read(size)
 
 
@@ -128,6 +177,23 @@ class ubi_file(object):
         return self._fhandle.tell()
 
 
+    def fileno(self):
+        return self._file.fileno()
+
+
+    def readahead(self):
+        if not hasattr(os, 'posix_fadvise'):
+            return
+
+        length = self.end_offset - self.start_offset
+        try:
+            os.posix_fadvise(self.fileno(), self.start_offset, length, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(self.fileno(), self.start_offset, length, os.POSIX_FADV_WILLNEED)
+            log(self, 'Readahead: %s, length: %s', self.start_offset, length)
+        except OSError as e:
+            log(self, 'Readahead failed: %s', e)
+
+
     def last_read_addr(self):
         return self._last_read_addr
 
@@ -211,7 +277,7 @@ class leb_virtual_file():
             error(self.read, 'Error', 'LEB: %s is corrupted or has no data.' % (leb))
             raise Exception('Bad Read Offset Request')
 
-        verbose_log(self, 'read loc: %s, size: %s' % (self._last_read_addr, size))
+        verbose_log(self, 'read loc: %s, size: %s', self._last_read_addr, size)
 
         if leb == self._last_leb:
             self.seek(self.tell() + size)
@@ -20,6 +20,8 @@
 from lzallright import LZOCompressor
 import struct
 import zlib
+import threading
+from ubireader import settings
 from ubireader.ubifs.defines import *
 from ubireader.debug import error, verbose_log
 from ubireader.debug import error
@@ -30,6 +32,9 @@ ino_types = ['file', 'dir','lnk','blk','chr','fifo','sock']
 node_types = ['ino','data','dent','xent','trun','pad','sb','mst','ref','idx','cs','orph']
 key_types = ['ino','data','dent','xent']
 
+# Serializes seek/read pairs on the image file between extract threads.
+_read_lock = threading.Lock()
+
 
 def parse_key(key):
     """Parse node key
@@ -76,33 +81,38 @@ def decompress(ctype, unc_len, data):
         return data
 
 
-def process_reg_file(ubifs, inode, path, inodes):
+def process_reg_file_iter(ubifs, inode, path, inodes):
+    """Decompress regular file data one data node at a time.
+
+    Arguments:
+    Obj:ubifs    -- UBIFS object.
+    Dict:inode   -- Inode entry with ino/data nodes.
+    Str:path     -- File path, for logging.
+    Dict:inodes  -- Dict of ino/dent/file nodes keyed to inode number.
+
+    Yields:
+    (Int:offset, Bytes:data) for each data node in key order. Missing
+    data nodes are holes, nothing is yielded for them.
+    """
     try:
-        buf = bytearray()
         start_key = (UBIFS_DATA_KEY << UBIFS_S_KEY_BLOCK_BITS)
         if 'data' in inode:
             compr_type = 0
             sorted_data = sorted(inode['data'], key=lambda x: x.key['khash'])
-            last_khash = start_key - 1
 
             for data in sorted_data:
-                # If data nodes are missing in sequence, fill in blanks
-                # with \x00 * UBIFS_BLOCK_SIZE
-                if data.key['khash'] - last_khash != 1:
-                    while 1 != (data.key['khash'] - last_khash):
-                        buf += b'\x00' * UBIFS_BLOCK_SIZE
-                        last_khash += 1
-
                 compr_type = data.compr_type
-                ubifs.file.seek(data.offset)
-                d = ubifs.file.read(data.compr_len)
+                with _read_lock:
+                    ubifs.file.seek(data.offset)
+                    d = ubifs.file.read(data.compr_len)
+
+                # block_id is based on the current hash
+                # there could be empty blocks
+                block_id = data.key['khash']-start_key
 
                 if ubifs.master_key is not None:
                     nonce = lookup_inode_nonce(inodes, inode)
                     block_key = derive_key_from_nonce(ubifs.master_key, nonce)
-                    # block_id is based on the current hash
-                    # there could be empty blocks
-                    block_id = data.key['khash']-start_key
                     block_iv = struct.pack("<QQ", block_id, 0)
                     d = datablock_decrypt(block_key, block_iv, d)
                     # if unpading is needed the plaintext_size is valid and set to the
@@ -110,13 +120,25 @@ def process_reg_file(ubifs, inode, path, inodes):
                     # of bytes to unpad
                     d = d[:data.plaintext_size]
 
-                buf += decompress(compr_type, data.size, d)
+                d = decompress(compr_type, data.size, d)
+                if d is None:
+                    raise Exception('Data node at block %s could not be decompressed' % block_id)
 
-                last_khash = data.key['khash']
-                verbose_log(process_reg_file, 'ino num: %s, compression: %s, path: %s' % (inode['ino'].key['ino_num'], compr_type, path))
+                if settings.logging_on_verbose:
+                    verbose_log(process_reg_file_iter, 'ino num: %s, compression: %s, path: %s', inode['ino'].key['ino_num'], compr_type, path)
+                yield block_id * UBIFS_BLOCK_SIZE, d
 
     except Exception as e:
-        error(process_reg_file, 'Warn', 'inode num:%s path:%s :%s' % (inode['ino'].key['ino_num'], path, e))
+        error(process_reg_file_iter, 'Warn', 'inode num:%s path:%s :%s' % (inode['ino'].key['ino_num'], path, e))
+
+
+def process_reg_file(ubifs, inode, path, inodes):
+    buf = bytearray()
+    for offset, data in process_reg_file_iter(ubifs, inode, path, inodes):
+        # If data nodes are missing in sequence, fill in blanks with \x00
+        if offset > len(buf):
+            buf += b'\x00' * (offset - len(buf))
+        buf[offset:offset+len(data)] = data
 
     # Pad end of file with \x00 if needed.
     if inode['ino'].size > len(buf):
@@ -18,19 +18,47 @@
 #############################################################
 
 import os
+import mmap
+import errno
+import shutil
 import struct
+import threading
+from functools import partial
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from ubireader.ubifs.decrypt import decrypt_symlink_target
 from ubireader import settings
 from ubireader.ubifs.defines import *
 from ubireader.ubifs import walk
-from ubireader.ubifs.misc import process_reg_file
+from ubireader.ubifs.misc import process_reg_file_iter
 from ubireader.debug import error, log, verbose_log
 
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows, where there is no O_DIRECT either.
+    fcntl = None
+
+# Most buffers a single pwritev call accepts, sysconf gives -1 when
+# there is no set limit.
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 0
+if _IOV_MAX <= 0:
+    _IOV_MAX = 1024
+
+# O_DIRECT writes are streamed in blocks of this size, page aligned.
+_DIRECT_BLOCK_SIZE = 1 << 20
+
+# Per thread scratch buffers, see _direct_buffer.
+_thread_local = threading.local()
+
+
 def is_safe_path(basedir, path):
-    basedir = os.path.realpath(basedir)
-    path = os.path.realpath(os.path.join(basedir, path))
-    return True if path.startswith(basedir) else False
+    """Check path is basedir or inside it, both resolved with realpath."""
+    return os.path.commonpath((basedir, path)) == basedir
 
 
 def extract_files(ubifs, out_path, perms=False):
@@ -49,8 +77,56 @@ def extract_files(ubifs, out_path, perms=False):
         if len(inodes) < 2:
             raise Exception('No inodes found')
 
-        for dent in inodes[1]['dent']:
-            extract_dents(ubifs, inodes, dent, out_path, perms)
+        # Walk the tree breadth first with an explicit queue, deep
+        # trees would otherwise hit the interpreter recursion limit.
+        # Regular files are decompressed and written by a thread pool.
+        dirs = {}
+        failed = []
+        # Parent paths in the queue are resolved, the root once here.
+        real_out_path = os.path.realpath(out_path)
+        queue = deque((dent, real_out_path) for dent in inodes[1]['dent'])
+        if settings.extract_jobs is None:
+            jobs = os.cpu_count() or 1
+        elif settings.extract_jobs < 1:
+            raise Exception('Extract jobs must be 1 or more, got %s' % settings.extract_jobs)
+        else:
+            jobs = settings.extract_jobs
+
+        executor = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+        try:
+            while queue:
+                # Re-raise anything a worker could not handle, e.g. fatal
+                # exits, as soon as it happens.
+                if failed:
+                    failed[0].result()
+
+                dent, path = queue.popleft()
+                extract_dents(ubifs, inodes, dent, path, perms, queue, dirs, executor, failed)
+        except BaseException:
+            # Do not extract the rest of the queued files.
+            if executor:
+                executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        else:
+            if executor:
+                executor.shutdown(wait=True)
+        finally:
+            # Worker buffers go with their threads, drop the walker's.
+            _release_direct_buffer()
+
+        if failed:
+            failed[0].result()
+
+        # Directory metadata is set once all their children exist,
+        # deepest first so timestamps are not changed by later writes
+        # and restrictive modes do not block creating children.
+        for dent_path, (inode, set_perms) in reversed(dirs.items()):
+            try:
+                if set_perms:
+                    _set_file_perms(dent_path, inode)
+                _set_file_timestamps(dent_path, inode)
+            except Exception as e:
+                error(extract_files, 'Warn', 'DIR Meta Fail: %s' % e)
 
         if len(bad_blocks):
             error(extract_files, 'Warn', 'Data may be missing or corrupted, bad blocks, LEB [%s]' % ','.join(map(str, bad_blocks)))
@@ -59,118 +135,398 @@ def extract_files(ubifs, out_path, perms=False):
         error(extract_files, 'Error', '%s' % e)
 
 
-def extract_dents(ubifs, inodes, dent_node, path='', perms=False):
+def extract_dents(ubifs, inodes, dent_node, path, perms, queue, dirs, executor=None, failed=None):
+    """Extract a single directory entry.
+
+    Arguments:
+    Obj:ubifs       -- UBIFS object.
+    Dict:inodes     -- Dict of ino/dent/file nodes keyed to inode number.
+    Obj:dent_node   -- Directory entry node to extract.
+    Str:path        -- Path of the parent directory, resolved.
+    Bool:perms      -- Set file permissions and ownership.
+    Deque:queue     -- Pending (dent_node, path) entries, children of
+                       directories are appended here.
+    Dict:dirs       -- Extracted directories, path to (inode, set_perms),
+                       metadata is set by the caller after the walk.
+    Obj:executor    -- (optional) Executor regular files are extracted
+                       with.
+    List:failed     -- (optional) Futures of workers that raised are
+                       appended here as they finish.
+    """
     if dent_node.inum not in inodes:
         error(extract_dents, 'Error', 'inum: %s not found in inodes' % (dent_node.inum))
         return
 
     inode = inodes[dent_node.inum]
 
-    if not is_safe_path(path, dent_node.name):
+    dent_path = os.path.realpath(os.path.join(path, dent_node.name))
+    if not is_safe_path(path, dent_path):
         error(extract_dents, 'Warn', 'Path traversal attempt: %s, discarding.' % (dent_node.name))
         return
-    dent_path = os.path.realpath(os.path.join(path, dent_node.name))
 
-    if dent_node.type == UBIFS_ITYPE_DIR:
-        try:
-            if not os.path.exists(dent_path):
-                os.mkdir(dent_path)
-                log(extract_dents, 'Make Dir: %s' % (dent_path))
+    handler = _DENT_HANDLERS.get(dent_node.type)
+    if handler:
+        handler(ubifs, inodes, dent_node, inode, dent_path, perms, queue, dirs, executor, failed)
+
+
+def _extract_dir(ubifs, inodes, dent_node, inode, dent_path, perms, queue, dirs, executor, failed):
+    # Already extracted in this run.
+    if dent_path in dirs:
+        return
+
+    set_perms = False
+    try:
+        os.mkdir(dent_path)
+        log(_extract_dir, 'Make Dir: %s', dent_path)
+        set_perms = perms
+    except FileExistsError:
+        pass
+    except Exception as e:
+        error(_extract_dir, 'Warn', 'DIR Fail: %s' % e)
+
+    if 'dent' in inode:
+        queue.extend((dnode, dent_path) for dnode in inode['dent'])
+
+    dirs[dent_path] = (inode, set_perms)
+
+
+def _extract_reg(ubifs, inodes, dent_node, inode, dent_path, perms, queue, dirs, executor, failed):
+    if inode['ino'].nlink > 1:
+        if 'hlink' not in inode:
+            # Later links need this copy on disk, extract it here.
+            inode['hlink'] = dent_path
+            _extract_reg_inode(ubifs, inodes, inode, dent_path, perms)
+        else:
+            try:
+                try:
+                    os.link(inode['hlink'], dent_path)
+                    log(_extract_reg, 'Make Link: %s > %s', dent_path, inode['hlink'])
+                except OSError as e:
+                    # Target does not support hardlinks, copy the data
+                    # already extracted instead of decompressing again.
+                    if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                        raise
+                    _copy_reg_file(inode['hlink'], dent_path)
+                    log(_extract_reg, 'Copy Link: %s > %s', dent_path, inode['hlink'])
+
+                _set_file_timestamps(dent_path, inode)
 
                 if perms:
                     _set_file_perms(dent_path, inode)
-        except Exception as e:
-            error(extract_dents, 'Warn', 'DIR Fail: %s' % e)
 
-        if 'dent' in inode:
-            for dnode in inode['dent']:
-                extract_dents(ubifs, inodes, dnode, dent_path, perms)
+            except Exception as e:
+                error(_extract_reg, 'Warn', 'FILE Fail: %s' % e)
 
+    elif executor:
+        future = executor.submit(_extract_reg_inode, ubifs, inodes, inode, dent_path, perms)
+        future.add_done_callback(partial(_record_failure, failed))
+    else:
+        _extract_reg_inode(ubifs, inodes, inode, dent_path, perms)
+
+
+def _record_failure(failed, future):
+    if not future.cancelled() and future.exception() is not None:
+        failed.append(future)
+
+
+def _extract_lnk(ubifs, inodes, dent_node, inode, dent_path, perms, queue, dirs, executor, failed):
+    try:
+        # probably will need to decompress ino data if > UBIFS_MIN_COMPR_LEN
+        lnkname = decrypt_symlink_target(ubifs, inodes, dent_node)
+        os.symlink('%s' % lnkname, dent_path)
         _set_file_timestamps(dent_path, inode)
+        log(_extract_lnk, 'Make Symlink: %s > %s', dent_path, inode['ino'].data)
 
-    elif dent_node.type == UBIFS_ITYPE_REG:
-        try:
-            if inode['ino'].nlink > 1:
-                if 'hlink' not in inode:
-                    inode['hlink'] = dent_path
-                    buf = process_reg_file(ubifs, inode, dent_path, inodes)
-                    _write_reg_file(dent_path, buf)
-                else:
-                    os.link(inode['hlink'], dent_path)
-                    log(extract_dents, 'Make Link: %s > %s' % (dent_path, inode['hlink']))
-            else:
-                buf = process_reg_file(ubifs, inode, dent_path, inodes)
-                _write_reg_file(dent_path, buf)
+    except Exception as e:
+        error(_extract_lnk, 'Warn', 'SYMLINK Fail: %s' % e)
 
-            _set_file_timestamps(dent_path, inode)
+
+def _extract_dev(ubifs, inodes, dent_node, inode, dent_path, perms, queue, dirs, executor, failed):
+    try:
+        dev = struct.unpack('<II', inode['ino'].data)[0]
+        if not settings.use_dummy_devices:
+            os.mknod(dent_path, inode['ino'].mode, dev)
+            log(_extract_dev, 'Make Device Node: %s', dent_path)
 
             if perms:
                 _set_file_perms(dent_path, inode)
+        else:
+            log(_extract_dev, 'Create dummy device.')
+            _write_reg_file(dent_path, str(dev).encode())
 
-        except Exception as e:
-            error(extract_dents, 'Warn', 'FILE Fail: %s' % e)
+            if perms:
+                _set_file_perms(dent_path, inode)
 
-    elif dent_node.type == UBIFS_ITYPE_LNK:
-        try:
-            # probably will need to decompress ino data if > UBIFS_MIN_COMPR_LEN
-            inode = inodes[dent_node.inum]
-            lnkname = decrypt_symlink_target(ubifs, inodes, dent_node)
-            os.symlink('%s' % lnkname, dent_path)
-            _set_file_timestamps(dent_path, inode)
-            log(extract_dents, 'Make Symlink: %s > %s' % (dent_path, inode['ino'].data))
+    except Exception as e:
+        error(_extract_dev, 'Warn', 'DEV Fail: %s' % e)
 
-        except Exception as e:
-            error(extract_dents, 'Warn', 'SYMLINK Fail: %s' % e) 
 
-    elif dent_node.type in [UBIFS_ITYPE_BLK, UBIFS_ITYPE_CHR]:
-        try:
-            dev = struct.unpack('<II', inode['ino'].data)[0]
-            if not settings.use_dummy_devices:
-                os.mknod(dent_path, inode['ino'].mode, dev)
-                log(extract_dents, 'Make Device Node: %s' % (dent_path))
-
-                if perms:
-                    _set_file_perms(dent_path, inode)
-            else:
-                log(extract_dents, 'Create dummy device.')
-                _write_reg_file(dent_path, str(dev))
+def _extract_fifo(ubifs, inodes, dent_node, inode, dent_path, perms, queue, dirs, executor, failed):
+    try:
+        os.mkfifo(dent_path, inode['ino'].mode)
+        log(_extract_fifo, 'Make FIFO: %s', dent_path)
 
-                if perms:
-                    _set_file_perms(dent_path, inode)
-                
-        except Exception as e:
-            error(extract_dents, 'Warn', 'DEV Fail: %s' % e)
+        if perms:
+            _set_file_perms(dent_path, inode)
+    except Exception as e:
+        error(_extract_fifo, 'Warn', 'FIFO Fail: %s : %s' % (dent_path, e))
 
-    elif dent_node.type == UBIFS_ITYPE_FIFO:
-        try:
-            os.mkfifo(dent_path, inode['ino'].mode)
-            log(extract_dents, 'Make FIFO: %s' % (path))
 
+def _extract_sock(ubifs, inodes, dent_node, inode, dent_path, perms, queue, dirs, executor, failed):
+    try:
+        if settings.use_dummy_socket_file:
+            _write_reg_file(dent_path, b'')
             if perms:
                 _set_file_perms(dent_path, inode)
-        except Exception as e:
-            error(extract_dents, 'Warn', 'FIFO Fail: %s : %s' % (dent_path, e))
+    except Exception as e:
+        error(_extract_sock, 'Warn', 'SOCK Fail: %s : %s' % (dent_path, e))
 
-    elif dent_node.type == UBIFS_ITYPE_SOCK:
-        try:
-            if settings.use_dummy_socket_file:
-                _write_reg_file(dent_path, '')
-                if perms:
-                    _set_file_perms(dent_path, inode)
-        except Exception as e:
-            error(extract_dents, 'Warn', 'SOCK Fail: %s : %s' % (dent_path, e))
+
+# Dent type to extract function, looked up once per entry.
+_DENT_HANDLERS = {
+    UBIFS_ITYPE_DIR: _extract_dir,
+    UBIFS_ITYPE_REG: _extract_reg,
+    UBIFS_ITYPE_LNK: _extract_lnk,
+    UBIFS_ITYPE_BLK: _extract_dev,
+    UBIFS_ITYPE_CHR: _extract_dev,
+    UBIFS_ITYPE_FIFO: _extract_fifo,
+    UBIFS_ITYPE_SOCK: _extract_sock,
+}
 
 
 def _set_file_perms(path, inode):
     os.chown(path, inode['ino'].uid, inode['ino'].gid)
     os.chmod(path, inode['ino'].mode)
-    verbose_log(_set_file_perms, 'perms:%s, owner: %s.%s, path: %s' % (inode['ino'].mode, inode['ino'].uid, inode['ino'].gid, path))
+    if settings.logging_on_verbose:
+        verbose_log(_set_file_perms, 'perms:%s, owner: %s.%s, path: %s', inode['ino'].mode, inode['ino'].uid, inode['ino'].gid, path)
 
 def _set_file_timestamps(path, inode):
-    os.utime(path, (inode['ino'].atime_sec, inode['ino'].mtime_sec), follow_symlinks = False)
-    verbose_log(_set_file_timestamps, 'timestamps: access: %s, modify: %s, path: %s' % (inode['ino'].atime_sec, inode['ino'].mtime_sec, path))
+    # Integer nanoseconds skip the float conversion of the times tuple.
+    os.utime(path, ns=(inode['ino'].atime_sec * 1000000000, inode['ino'].mtime_sec * 1000000000), follow_symlinks = False)
+    if settings.logging_on_verbose:
+        verbose_log(_set_file_timestamps, 'timestamps: access: %s, modify: %s, path: %s', inode['ino'].atime_sec, inode['ino'].mtime_sec, path)
+
+def _extract_reg_inode(ubifs, inodes, inode, path, perms):
+    try:
+        _extract_reg_file(ubifs, inodes, inode, path)
+        _set_file_timestamps(path, inode)
+
+        if perms:
+            _set_file_perms(path, inode)
+
+    except Exception as e:
+        error(_extract_reg_inode, 'Warn', 'FILE Fail: %s' % e)
+
+def _extract_reg_file(ubifs, inodes, inode, path):
+    chunks = process_reg_file_iter(ubifs, inode, path, inodes)
+    size = inode['ino'].size
+
+    if settings.direct_io_threshold and size >= settings.direct_io_threshold:
+        _write_direct_file(path, chunks, size)
+    else:
+        _write_reg_chunks(path, chunks, size)
+    log(_extract_reg_file, 'Make File: %s', path)
 
 def _write_reg_file(path, data):
-    with open(path, 'wb') as f:
-        f.write(data)
-    log(_write_reg_file, 'Make File: %s' % (path))
+    fd = _create_file(path)
+    try:
+        _write_all(fd, data)
+    finally:
+        os.close(fd)
+    log(_write_reg_file, 'Make File: %s', path)
+
+def _write_reg_chunks(path, chunks, size):
+    """Stream (offset, data) chunks to path, zero filling any holes.
+
+    Chunks are written as they are decompressed, the whole file is
+    never held in memory.
+    """
+    fd = _create_file(path)
+    try:
+        if size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                pass
+
+        # Runs of contiguous chunks go out in one pwritev call.
+        end = 0
+        batch = []
+        batch_offset = batch_end = 0
+        for offset, data in chunks:
+            if batch and (offset != batch_end or len(batch) >= _IOV_MAX):
+                _write_all_vectored(fd, batch, batch_offset)
+                batch = []
+
+            if not batch:
+                batch_offset = batch_end = offset
+
+            batch.append(data)
+            batch_end += len(data)
+            end = max(end, batch_end)
+
+        if batch:
+            _write_all_vectored(fd, batch, batch_offset)
+
+        # Pad end of file with \x00 if needed.
+        if size > end:
+            os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+def _write_direct_file(path, chunks, size):
+    """Stream (offset, data) chunks to path bypassing the page cache.
+
+    Chunks are gathered in a page aligned buffer and written a block
+    at a time, only the last block is padded and then truncated.
+    Falls back to buffered writes if O_DIRECT is not supported by the
+    platform or the target filesystem.
+    """
+    if not hasattr(os, 'O_DIRECT'):
+        return _write_reg_chunks(path, chunks, size)
+
+    try:
+        fd = _create_file(path, os.O_DIRECT)
+    except OSError as e:
+        if e.errno == errno.EINVAL:
+            # The refused open may have left the new file behind.
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            return _write_reg_chunks(path, chunks, size)
+        raise
+
+    try:
+        buf = _direct_buffer()
+        block_start = 0
+        fill = 0
+        for offset, data in chunks:
+            view = memoryview(data)
+            # Data nodes come sorted, a duplicate block can only
+            # overlap what was already written out.
+            if offset < block_start:
+                view = view[block_start - offset:]
+                offset = block_start
+
+            while view:
+                pos = offset - block_start
+                if pos >= _DIRECT_BLOCK_SIZE:
+                    if fill:
+                        _write_direct_block(fd, buf, fill, _DIRECT_BLOCK_SIZE, block_start)
+                    # Skip whole blocks of holes.
+                    block_start = offset - (offset % _DIRECT_BLOCK_SIZE)
+                    fill = 0
+                    continue
+
+                if pos > fill:
+                    buf[fill:pos] = bytes(pos - fill)
+                n = min(len(view), _DIRECT_BLOCK_SIZE - pos)
+                buf[pos:pos+n] = view[:n]
+                fill = max(fill, pos + n)
+                view = view[n:]
+                offset += n
+
+        end = block_start + fill
+        if fill:
+            _write_direct_block(fd, buf, fill, _page_align(fill), block_start)
+
+        # Drop the last block padding, pad end of file with \x00 if needed.
+        os.ftruncate(fd, max(size, end))
+    finally:
+        os.close(fd)
+
+def _write_direct_block(fd, buf, fill, length, offset):
+    # Zero the unused tail, it is written out as padding.
+    if length > fill:
+        buf[fill:length] = bytes(length - fill)
+
+    with memoryview(buf) as view:
+        try:
+            _write_all(fd, view[:length], offset)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            # Filesystem refused O_DIRECT writes, continue buffered.
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+            _write_all(fd, view[:length], offset)
+
+def _direct_buffer():
+    """Page aligned _DIRECT_BLOCK_SIZE buffer for O_DIRECT writes.
+
+    Kept one per thread and reused across files.
+    """
+    # Anonymous maps are page aligned and _DIRECT_BLOCK_SIZE is a page
+    # multiple, so every write satisfies the O_DIRECT alignment rules.
+    buf = getattr(_thread_local, 'direct_buf', None)
+    if buf is None:
+        buf = _thread_local.direct_buf = mmap.mmap(-1, _DIRECT_BLOCK_SIZE)
+    return buf
+
+def _release_direct_buffer():
+    buf = getattr(_thread_local, 'direct_buf', None)
+    if buf is not None:
+        buf.close()
+        del _thread_local.direct_buf
+
+def _copy_reg_file(src, dst):
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = _create_file(dst)
+        try:
+            # Copied in kernel, filesystems with reflinks share the blocks.
+            try:
+                size = os.fstat(src_fd).st_size
+                copied = 0
+                while copied < size:
+                    n = os.copy_file_range(src_fd, dst_fd, size - copied, copied, copied)
+                    if not n:
+                        break
+                    copied += n
+                return
+            except (AttributeError, OSError):
+                pass
+
+            # No copy_file_range, older kernels or cross filesystem copies.
+            os.ftruncate(dst_fd, 0)
+            with open(src_fd, 'rb', closefd=False) as fsrc, open(dst_fd, 'wb', closefd=False) as fdst:
+                shutil.copyfileobj(fsrc, fdst)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+def _create_file(path, flags=0):
+    """Create path for writing, it must not exist yet.
+
+    Never follows a symlink at path. Workers open their files after the
+    walk has moved on, a later dent of the same name could have been
+    made a symlink pointing outside the output directory by then.
+    """
+    flags |= os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_NOFOLLOW', 0)
+    return os.open(path, flags, 0o666)
+
+def _write_all(fd, data, offset=None):
+    view = memoryview(data)
+    while view:
+        if offset is None:
+            written = os.write(fd, view)
+        else:
+            written = os.pwrite(fd, view, offset)
+            offset += written
+        view = view[written:]
+
+def _write_all_vectored(fd, buffers, offset):
+    if not hasattr(os, 'pwritev'):
+        for data in buffers:
+            _write_all(fd, data, offset)
+            offset += len(data)
+        return
+
+    written = os.pwritev(fd, buffers, offset)
+    total = sum(len(data) for data in buffers)
+    if written < total:
+        _write_all(fd, b''.join(buffers)[written:], offset + written)
+
+def _page_align(size):
+    return (size + mmap.PAGESIZE - 1) & ~(mmap.PAGESIZE - 1)
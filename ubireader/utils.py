@@ -17,47 +17,70 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #############################################################
 
+import os
 import re
+import mmap
+import json
+import contextlib
+import hashlib
+import tempfile
 from ubireader.debug import error, log
 from ubireader.ubi.defines import UBI_EC_HDR_MAGIC, FILE_CHUNK_SZ
 from ubireader.ubifs.defines import UBIFS_NODE_MAGIC, UBIFS_SB_NODE_SZ, UBIFS_SB_NODE, UBIFS_COMMON_HDR_SZ
 from ubireader.ubifs import nodes
 
-def guess_start_offset(path, guess_offset=0):
-    file_offset = guess_offset
+def _find_magic(f, magics, start=0, end=None):
+    """Yield (offset, magic) for any of magics in an open file, from start up to end.
 
-    f = open(path, 'rb')
-    f.seek(0,2)
-    file_size = f.tell()+1
-    f.seek(guess_offset)
+    All magics are matched in a single pass. The file is searched through
+    a memory map when possible, otherwise in FILE_CHUNK_SZ reads
+    overlapping by the longest magic less one byte. The file position is
+    not relied on between offsets, callers may seek.
+    """
+    pattern = re.compile(b'|'.join(re.escape(magic) for magic in magics))
+
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError, OverflowError):
+        # Devices report no size and can not be mapped.
+        mapped = None
+
+    if mapped is not None:
+        with contextlib.closing(mapped):
+            for m in pattern.finditer(mapped, start, len(mapped) if end is None else end):
+                yield m.start(), m.group()
+        return
+
+    overlap = max(len(magic) for magic in magics) - 1
+    offset = start
+    tail = b''
+    while end is None or offset < end:
+        f.seek(offset)
+        data = f.read(FILE_CHUNK_SZ)
+        if not data:
+            break
+
+        buf = tail + data
+        base = offset - len(tail)
+        for m in pattern.finditer(buf):
+            if end is not None and base + m.end() > end:
+                return
+            yield base + m.start(), m.group()
+
+        offset += len(data)
+        tail = buf[-overlap:] if overlap else b''
 
-    for _ in range(0, file_size, FILE_CHUNK_SZ):
-        buf = f.read(FILE_CHUNK_SZ)
-        ubi_loc = buf.find(UBI_EC_HDR_MAGIC)
-        ubifs_loc = buf.find(UBIFS_NODE_MAGIC)
 
-        if ubi_loc == -1 and ubifs_loc == -1:
-            file_offset += FILE_CHUNK_SZ
-            continue
-        else:
-            if ubi_loc == -1:
-                ubi_loc = file_size + 1
-            elif ubifs_loc == -1:
-                ubifs_loc = file_size + 1
-
-            if ubi_loc < ubifs_loc:
-                log(guess_start_offset, 'Found UBI magic number at %s' % (file_offset + ubi_loc))
-                return  file_offset + ubi_loc
-
-            elif ubifs_loc < ubi_loc:
-                log(guess_start_offset, 'Found UBIFS magic number at %s' % (file_offset + ubifs_loc))
-                return file_offset + ubifs_loc
+def guess_start_offset(path, guess_offset=0):
+    with open(path, 'rb') as f:
+        for loc, magic in _find_magic(f, (UBI_EC_HDR_MAGIC, UBIFS_NODE_MAGIC), guess_offset):
+            if magic == UBIFS_NODE_MAGIC:
+                log(guess_start_offset, 'Found UBIFS magic number at %s' % (loc))
             else:
-                error(guess_start_offset, 'Fatal', 'Could not determine start offset.')
-    else:
-        error(guess_start_offset, 'Fatal', 'Could not determine start offset.')
+                log(guess_start_offset, 'Found UBI magic number at %s' % (loc))
+            return loc
 
-    f.close()
+    error(guess_start_offset, 'Fatal', 'Could not determine start offset.')
 
 
 def guess_filetype(path, start_offset=0):
@@ -93,36 +116,16 @@ def guess_leb_size(path):
     Searches file for superblock and retrieves leb size.
     """
 
-    f = open(path, 'rb')
-    f.seek(0,2)
-    file_size = f.tell()+1
-    f.seek(0)
-    block_size = None
-
-    for _ in range(0, file_size, FILE_CHUNK_SZ):
-        buf = f.read(FILE_CHUNK_SZ)
-
-        for m in re.finditer(UBIFS_NODE_MAGIC, buf):
-            start = m.start()
-            chdr = nodes.common_hdr(buf[start:start+UBIFS_COMMON_HDR_SZ])
+    with open(path, 'rb') as f:
+        for start, _ in _find_magic(f, (UBIFS_NODE_MAGIC,)):
+            f.seek(start)
+            chdr = nodes.common_hdr(f.read(UBIFS_COMMON_HDR_SZ))
 
             if chdr and chdr.node_type == UBIFS_SB_NODE:
-                sb_start = start + UBIFS_COMMON_HDR_SZ
-                sb_end = sb_start + UBIFS_SB_NODE_SZ
-
-                if chdr.len != len(buf[sb_start:sb_end]):
-                    f.seek(sb_start)
-                    buf = f.read(UBIFS_SB_NODE_SZ)
-                else:
-                    buf = buf[sb_start:sb_end]
+                sbn = nodes.sb_node(f.read(UBIFS_SB_NODE_SZ))
+                return sbn.leb_size
 
-                sbn = nodes.sb_node(buf)
-                block_size = sbn.leb_size
-                f.close()
-                return block_size
-
-    f.close()
-    return block_size
+    return None
 
 
 def guess_peb_size(path):
@@ -137,28 +140,8 @@ def guess_peb_size(path):
     Searches file for Magic Number, picks most 
         common length between them.
     """
-    file_offset = 0
-    offsets = []
-    f = open(path, 'rb')
-    f.seek(0,2)
-    file_size = f.tell()+1
-    f.seek(0)
-
-    for _ in range(0, file_size, FILE_CHUNK_SZ):
-        buf = f.read(FILE_CHUNK_SZ)
-        for m in re.finditer(UBI_EC_HDR_MAGIC, buf):
-            start = m.start()
-
-            if not file_offset:
-                file_offset = start
-                idx = start
-            else:
-                idx = start+file_offset
-
-            offsets.append(idx)
-
-        file_offset += FILE_CHUNK_SZ
-    f.close()
+    with open(path, 'rb') as f:
+        offsets = [loc for loc, _ in _find_magic(f, (UBI_EC_HDR_MAGIC,))]
 
     occurrences = {}
     for i in range(0, len(offsets)):
@@ -180,4 +163,65 @@ def guess_peb_size(path):
             most_frequent = occurrences[offset]
             block_size = offset
 
-    return block_size
\ No newline at end of file
+    return block_size
+
+
+# Bump when guessing changes, entries of other versions are ignored.
+GUESS_CACHE_VERSION = 1
+
+
+def _guess_cache_path(path, guess_offset):
+    """Cache file for path, keyed by its size, mtime and first 4KiB."""
+    st = os.stat(path)
+    key = hashlib.blake2b(digest_size=16)
+    key.update(('%s:%s:%s:%s' % (os.path.abspath(path), st.st_size, st.st_mtime_ns, guess_offset or 0)).encode())
+    with open(path, 'rb') as f:
+        key.update(f.read(4096))
+
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'ubi_reader', '%s.json' % key.hexdigest())
+
+
+def load_guess_cache(path, guess_offset=0):
+    """Get previously guessed image parameters
+
+    Arguments:
+    Str:path          -- Path to file.
+    Int:guess_offset  -- Offset guessing started at.
+
+    Returns:
+    Tuple             -- (start_offset, block_size, filetype) or None.
+    """
+    try:
+        with open(_guess_cache_path(path, guess_offset), 'r') as f:
+            cache = json.load(f)
+        if cache.get('version') != GUESS_CACHE_VERSION:
+            return None
+        guessed = (cache['start_offset'], cache['block_size'], bytes.fromhex(cache['filetype']))
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+    log(load_guess_cache, 'Using cached start offset: %s, block size: %s', guessed[0], guessed[1])
+    return guessed
+
+
+def save_guess_cache(path, guess_offset, start_offset, block_size, filetype):
+    """Store guessed image parameters for load_guess_cache."""
+    try:
+        cache_path = _guess_cache_path(path, guess_offset)
+        cache_dir = os.path.dirname(cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Written aside and renamed, concurrent runs never read a partial file.
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': GUESS_CACHE_VERSION,
+                           'start_offset': start_offset,
+                           'block_size': block_size,
+                           'filetype': filetype.hex()}, f)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError as e:
+        log(save_guess_cache, 'Could not write cache: %s', e)